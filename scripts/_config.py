@@ -0,0 +1,73 @@
+"""Shared configuration loading for the analysis scripts."""
+import functools
+import json
+import os
+import tempfile
+from pathlib import Path
+
+import yaml
+
+try:
+    # libyaml C bindings; only present when PyYAML was built against libyaml
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
+
+CONFIG_PATH = Path(__file__).parent.parent / "config" / "analysis_params.yaml"
+
+
+@functools.lru_cache(maxsize=1)
+def load_config(config_path=CONFIG_PATH):
+    """
+    Load analysis parameters from config file.
+
+    The parsed config is cached, so repeated calls within one process
+    return the same dict without re-reading the file. Call
+    ``load_config.cache_clear()`` after editing the file in-process.
+
+    Across processes, the parsed config is stored as JSON next to the
+    YAML file (``analysis_params.yaml.cache``) and reused while it is at
+    least as new as the YAML, so YAML is only parsed after the file
+    changes. JSON, like safe YAML loading, cannot execute code. Configs
+    that JSON cannot reproduce exactly (e.g. integer mapping keys or
+    dates) are not cached.
+
+    Args:
+        config_path: Path to the YAML parameters file
+
+    Returns:
+        Dict of analysis parameters
+    """
+    config_path = Path(config_path)
+    cache_path = config_path.with_suffix(config_path.suffix + ".cache")
+
+    try:
+        if cache_path.stat().st_mtime_ns >= config_path.stat().st_mtime_ns:
+            return json.loads(cache_path.read_bytes())
+    except (OSError, ValueError):
+        pass  # Missing, stale or unreadable cache: fall back to YAML
+
+    with open(config_path) as f:
+        config = yaml.load(f, Loader=_Loader)
+
+    try:
+        payload = json.dumps(config)
+    except (TypeError, ValueError):
+        return config
+    if json.loads(payload) != config:
+        return config  # A cache hit would return a different config
+
+    # Write to a temp file and rename it into place, so concurrent stages
+    # never read a partially written cache
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, prefix=cache_path.name)
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(payload)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except OSError:
+        pass  # Read-only checkout; parse the YAML again next run
+    return config
@@ -1,35 +1,55 @@
 """Differential abundance analysis for microbiome data."""
-import yaml
-from pathlib import Path
+import warnings
 
+import numpy as np
+import pandas as pd
+from scipy import sparse, stats
 
-def load_config():
-    """Load analysis parameters."""
-    config_path = Path(__file__).parent.parent / "config" / "analysis_params.yaml"
-    with open(config_path) as f:
-        return yaml.safe_load(f)
+from _config import load_config
 
+# Upper bound on Monte Carlo draws (instances x taxa x samples) per ALDEx2 batch
+ALDEX2_BATCH_ELEMENTS = 2 ** 24
 
-def filter_low_abundance(asv_table, min_prevalence=0.1, min_abundance=0.001):
+
+def filter_low_abundance(asv_table, min_prevalence=0.1, min_abundance=0.001, *, taxon_ids=None):
     """
     Filter ASVs with low prevalence or abundance.
 
     Removes rare taxa that may represent sequencing errors
     or have insufficient power for statistical testing.
 
+    A taxon is kept if it is present in at least ``min_prevalence`` of
+    samples and reaches ``min_abundance`` relative abundance in at
+    least one sample.
+
     Args:
-        asv_table: ASV count table
+        asv_table: ASV count table (taxa x samples)
         min_prevalence: Minimum fraction of samples with taxon
         min_abundance: Minimum relative abundance threshold
+        taxon_ids: Taxon identifiers, one per row of asv_table
 
     Returns:
-        Filtered ASV table
+        Filtered sparse table in the input dtype, or a tuple of
+        (filtered table, filtered taxon_ids) when taxon_ids is given
     """
     print(f"Filtering: prevalence >= {min_prevalence}, abundance >= {min_abundance}")
-    return asv_table
+    # Keep the input dtype: relative-abundance tables must not be truncated
+    counts = sparse.csr_matrix(asv_table, copy=True)
+    counts.eliminate_zeros()
+
+    # Empty samples get zero relative abundance instead of 0/0
+    lib_size = np.asarray(counts.sum(axis=0)).ravel()
+    inv_lib = np.divide(1.0, lib_size, out=np.zeros(lib_size.shape), where=lib_size > 0)
+    max_rel = counts.multiply(inv_lib[None, :]).tocsr().max(axis=1).toarray().ravel()
 
+    prevalence = counts.getnnz(axis=1) / counts.shape[1]
+    keep = (prevalence >= min_prevalence) & (max_rel >= min_abundance)
+    if taxon_ids is None:
+        return counts[keep]
+    return counts[keep], np.asarray(taxon_ids, dtype=object)[keep]
 
-def run_deseq2(counts, groups, alpha=0.05):
+
+def run_deseq2(counts, groups, alpha=0.05, *, taxon_ids=None):
     """
     Run DESeq2 differential abundance analysis.
 
@@ -40,6 +60,7 @@ def run_deseq2(counts, groups, alpha=0.05):
         counts: Raw count matrix
         groups: Sample group assignments
         alpha: Significance threshold for adjusted p-values
+        taxon_ids: Taxon identifiers, one per row of counts
 
     Returns:
         DataFrame with log2 fold changes and adjusted p-values
@@ -47,15 +68,14 @@ def run_deseq2(counts, groups, alpha=0.05):
     print(f"Running DESeq2 with alpha={alpha}...")
 
     # Simulated results
-    results = [
-        {"taxon": "Bacteroides", "log2fc": 2.1, "padj": 0.001},
-        {"taxon": "Prevotella", "log2fc": -1.5, "padj": 0.02},
-        {"taxon": "Akkermansia", "log2fc": 1.8, "padj": 0.003},
-    ]
-    return results
+    return pd.DataFrame({
+        "taxon": pd.Categorical(["Bacteroides", "Prevotella", "Akkermansia"]),
+        "log2fc": [2.1, -1.5, 1.8],
+        "padj": [0.001, 0.02, 0.003],
+    })
 
 
-def run_ancom(counts, groups):
+def run_ancom(counts, groups, *, taxon_ids=None):
     """
     Run ANCOM differential abundance analysis.
 
@@ -65,31 +85,121 @@ def run_ancom(counts, groups):
     Args:
         counts: Count matrix
         groups: Sample group assignments
+        taxon_ids: Taxon identifiers, one per row of counts
 
     Returns:
-        ANCOM results with W statistics
+        DataFrame of ANCOM W statistics and detection calls
     """
     print("Running ANCOM analysis...")
 
-    results = [
-        {"taxon": "Bacteroides", "W": 45, "detected": True},
-        {"taxon": "Faecalibacterium", "W": 38, "detected": True},
-    ]
-    return results
+    return pd.DataFrame({
+        "taxon": pd.Categorical(["Bacteroides", "Faecalibacterium"]),
+        "W": [45, 38],
+        "detected": [True, True],
+    })
 
 
-def run_aldex2(counts, groups):
+def run_aldex2(counts, groups, mc_samples=128, seed=None, *, taxon_ids=None):
     """
     Run ALDEx2 differential abundance analysis.
 
     ALDEx2 uses centered log-ratio transformation and
     models per-feature technical variation.
 
+    Each Monte Carlo instance draws a Dirichlet(counts + 0.5) composition
+    per sample. The draws come from one generator as a single
+    (instances x taxa x samples) gamma array per batch; since CLR removes
+    the per-sample scale, the gamma draws need no normalization. Welch's
+    t-test then runs across all taxa and instances at once. With a
+    single sample in a group the t-test is undefined, so it is skipped
+    with a warning and the p-values are NaN.
+
+    Args:
+        counts: Count matrix (taxa x samples)
+        groups: Sample group assignments (exactly two groups)
+        mc_samples: Number of Monte Carlo Dirichlet instances
+        seed: Seed for the Monte Carlo generator
+        taxon_ids: Taxon identifiers, one per row of counts
+
     Returns:
-        ALDEx2 effect sizes and p-values
+        DataFrame of ALDEx2 effect sizes and expected p-values
     """
     print("Running ALDEx2 analysis...")
-    return []
+    counts = counts.toarray() if sparse.issparse(counts) else np.asarray(counts)
+    n_taxa, n_samples = counts.shape
+    if taxon_ids is None:
+        taxon_ids = [f"ASV{i + 1}" for i in range(n_taxa)]
+
+    labels, codes = np.unique(np.asarray(groups), return_inverse=True)
+    if len(labels) != 2:
+        raise ValueError(f"ALDEx2 compares two groups, got {len(labels)}")
+    first, second = codes == 0, codes == 1
+    run_ttest = np.bincount(codes).min() >= 2
+    if not run_ttest:
+        warnings.warn(
+            "ALDEx2 needs at least two samples per group for Welch's t-test; "
+            "reporting NaN p-values",
+            RuntimeWarning,
+            stacklevel=2,
+        )
+
+    rng = np.random.default_rng(seed)
+    alpha = counts + 0.5
+    batch = max(1, ALDEX2_BATCH_ELEMENTS // max(n_taxa * n_samples, 1))
+    diff = np.zeros(n_taxa)
+    p_sum = np.zeros(n_taxa)
+    bh_sum = np.zeros(n_taxa)
+    for start in range(0, mc_samples, batch):
+        size = min(batch, mc_samples - start)
+        log_draws = np.log(rng.standard_gamma(alpha, size=(size, n_taxa, n_samples)))
+        clr = log_draws - log_draws.mean(axis=1, keepdims=True)
+
+        a, b = clr[:, :, first], clr[:, :, second]
+        diff += (b.mean(axis=2) - a.mean(axis=2)).sum(axis=0)
+        if run_ttest:
+            p = stats.ttest_ind(b, a, axis=2, equal_var=False).pvalue
+            p_sum += p.sum(axis=0)
+            bh_sum += stats.false_discovery_control(p, axis=1).sum(axis=0)
+
+    diff /= mc_samples
+    if run_ttest:
+        p_sum /= mc_samples
+        bh_sum /= mc_samples
+    else:
+        p_sum[:] = np.nan
+        bh_sum[:] = np.nan
+
+    return pd.DataFrame({
+        "taxon": pd.Categorical(taxon_ids),
+        "diff_btw": diff,
+        "we_ep": p_sum,
+        "we_eBH": bh_sum,
+        "padj": bh_sum,
+    })
+
+
+def _significant(results, threshold):
+    """Boolean mask of significant taxa.
+
+    A taxon is significant if its ``padj`` is below ``threshold`` (NaN never
+    is) or ANCOM flagged it ``detected``. Frames with neither column give an
+    all-False mask.
+    """
+    significant = np.zeros(len(results), dtype=bool)
+    if "padj" in results:
+        significant |= (results["padj"].fillna(1) < threshold).to_numpy()
+    if "detected" in results:
+        significant |= results["detected"].fillna(False).astype(bool).to_numpy()
+    return significant
+
+
+# Differential abundance methods by config name. Each is called as
+# method(counts, groups, taxon_ids=...).
+DIFFERENTIAL_METHODS = {
+    "deseq2": run_deseq2,
+    "ancom": run_ancom,
+    "aldex2": run_aldex2,
+}
 
 
 def run_differential_analysis():
@@ -103,28 +213,29 @@ def run_differential_analysis():
     print(f"Significance threshold: {config['significance_threshold']}")
     print(f"Min prevalence: {config['min_prevalence']}")
 
-    # Simulated data
-    asv_table = {"ASV1": [100, 50, 75], "ASV2": [200, 150, 180]}
+    # Simulated data (taxa x samples)
+    asv_table = sparse.csr_matrix(np.array([[100, 50, 75], [200, 150, 180]], dtype=np.int32))
+    taxon_ids = np.array(["ASV1", "ASV2"], dtype=object)
     groups = ["treatment", "control", "treatment"]
 
-    filtered = filter_low_abundance(
+    filtered, taxon_ids = filter_low_abundance(
         asv_table,
         config["min_prevalence"],
-        config["min_abundance"]
+        config["min_abundance"],
+        taxon_ids=taxon_ids,
     )
 
     method = config["differential_method"]
-    if method == "deseq2":
-        results = run_deseq2(filtered, groups, config["significance_threshold"])
-    elif method == "ancom":
-        results = run_ancom(filtered, groups)
-    elif method == "aldex2":
-        results = run_aldex2(filtered, groups)
-    else:
-        raise ValueError(f"Unknown method: {method}")
+    try:
+        run_method = DIFFERENTIAL_METHODS[method]
+    except KeyError:
+        raise ValueError(f"Unknown method: {method}") from None
+
+    # DESeq2 also uses the threshold for its independent filtering
+    options = {"alpha": config["significance_threshold"]} if run_method is run_deseq2 else {}
+    results = run_method(filtered, groups, taxon_ids=taxon_ids, **options)
 
-    sig_taxa = [r for r in results if r.get("padj", 0) < config["significance_threshold"]
-                or r.get("detected", False)]
+    sig_taxa = results[_significant(results, config["significance_threshold"])]
     print(f"\nFound {len(sig_taxa)} differentially abundant taxa")
 
     return results
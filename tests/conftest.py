@@ -0,0 +1,5 @@
+"""Make the pipeline scripts importable from the tests."""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "scripts"))
@@ -0,0 +1,66 @@
+"""Tests for scripts/_config.py."""
+import json
+import os
+
+import pytest
+
+import _config
+
+
+@pytest.fixture
+def config_path(tmp_path):
+    path = tmp_path / "analysis_params.yaml"
+    path.write_text("beta_metric: bray_curtis\nalpha_metrics:\n  - shannon\n")
+    _config.load_config.cache_clear()
+    yield path
+    _config.load_config.cache_clear()
+
+
+def _cache_path(config_path):
+    return config_path.with_name(config_path.name + ".cache")
+
+
+def test_load_config_is_memoized(config_path):
+    assert _config.load_config(config_path) is _config.load_config(config_path)
+
+
+def test_load_config_reads_fresh_cache(config_path):
+    expected = {"beta_metric": "bray_curtis", "alpha_metrics": ["shannon"]}
+    assert _config.load_config(config_path) == expected
+    assert json.loads(_cache_path(config_path).read_text()) == expected
+
+    # A cache at least as new as the YAML is used without parsing the YAML
+    _cache_path(config_path).write_text(json.dumps({"beta_metric": "jaccard"}))
+    stat = config_path.stat()
+    os.utime(_cache_path(config_path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    _config.load_config.cache_clear()
+
+    assert _config.load_config(config_path) == {"beta_metric": "jaccard"}
+
+
+def test_load_config_ignores_stale_cache(config_path):
+    _config.load_config(config_path)
+    _cache_path(config_path).write_text(json.dumps({"beta_metric": "jaccard"}))
+    stat = _cache_path(config_path).stat()
+    os.utime(config_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    _config.load_config.cache_clear()
+
+    assert _config.load_config(config_path)["beta_metric"] == "bray_curtis"
+
+
+def test_load_config_ignores_corrupt_cache(config_path):
+    _config.load_config(config_path)
+    _cache_path(config_path).write_text("{not json")
+    _config.load_config.cache_clear()
+
+    assert _config.load_config(config_path)["beta_metric"] == "bray_curtis"
+
+
+@pytest.mark.parametrize("value", ["{1: low, 2: high}", "2024-01-01"])
+def test_load_config_skips_cache_for_non_json_values(config_path, value):
+    config_path.write_text(f"levels: {value}\n")
+    first = _config.load_config(config_path)
+    _config.load_config.cache_clear()
+
+    assert not _cache_path(config_path).exists()
+    assert _config.load_config(config_path) == first
@@ -0,0 +1,107 @@
+"""Tests for scripts/differential_abundance.py."""
+import numpy as np
+import pandas as pd
+import pytest
+
+import differential_abundance
+
+
+def test_aldex2_two_groups_reports_p_values():
+    rng = np.random.default_rng(0)
+    counts = rng.poisson(50, (20, 8))
+    counts[0, 4:] *= 5
+    groups = ["control"] * 4 + ["treatment"] * 4
+
+    results = differential_abundance.run_aldex2(counts, groups, seed=1)
+
+    assert len(results) == 20
+    assert results["we_ep"].between(0, 1).all()
+    assert results["diff_btw"].iloc[0] > 1
+    assert results["padj"].iloc[0] < 0.05
+
+
+def test_aldex2_single_sample_group_returns_nan_p_values():
+    counts = np.array([[100, 50, 75], [200, 150, 180]])
+    groups = ["treatment", "control", "treatment"]
+
+    with pytest.warns(RuntimeWarning):
+        results = differential_abundance.run_aldex2(counts, groups, seed=0)
+
+    assert results["we_ep"].isna().all()
+    assert results["padj"].isna().all()
+    assert np.isfinite(results["diff_btw"]).all()
+
+
+def test_differential_analysis_runs_with_aldex2(monkeypatch):
+    config = dict(differential_abundance.load_config(), differential_method="aldex2")
+    monkeypatch.setattr(differential_abundance, "load_config", lambda: config)
+
+    with pytest.warns(RuntimeWarning):
+        results = differential_abundance.run_differential_analysis()
+
+    assert list(results["taxon"]) == ["ASV1", "ASV2"]
+
+
+def test_filter_low_abundance_positional_thresholds():
+    table = [[1, 0, 0, 0], [0, 0, 5, 0], [100, 100, 0, 0]]
+
+    filtered = differential_abundance.filter_low_abundance(table, 0.3, 0.05)
+
+    assert filtered.toarray().tolist() == [[100, 100, 0, 0]]
+
+
+def test_filter_low_abundance_keeps_dtype_and_ids():
+    table = np.array([[0.2, 0, 0, 0], [0, 0, 0.05, 0], [0.8, 1.0, 0, 0]])
+
+    filtered, taxa = differential_abundance.filter_low_abundance(
+        table, 0.3, 0.05, taxon_ids=["a", "b", "c"]
+    )
+
+    assert filtered.dtype == table.dtype
+    assert filtered.toarray().tolist() == [[0.8, 1.0, 0, 0]]
+    assert taxa.tolist() == ["c"]
+
+
+def test_significant_treats_nan_padj_as_not_significant():
+    results = pd.DataFrame({"padj": [0.01, np.nan, 0.2]})
+
+    mask = differential_abundance._significant(results, 0.05)
+
+    assert mask.tolist() == [True, False, False]
+
+
+def test_significant_ors_in_detected():
+    results = pd.DataFrame({
+        "padj": [0.01, np.nan, 0.2, 0.3],
+        "detected": [False, True, None, True],
+    })
+
+    mask = differential_abundance._significant(results, 0.05)
+
+    assert mask.tolist() == [True, True, False, True]
+
+
+def test_significant_without_padj_or_detected():
+    results = pd.DataFrame({"taxon": ["ASV1", "ASV2"], "log2FoldChange": [1.0, -2.0]})
+
+    mask = differential_abundance._significant(results, 0.05)
+
+    assert mask.tolist() == [False, False]
+
+
+def test_differential_methods_take_taxon_ids_by_keyword_only():
+    counts = np.array([[100, 50, 75], [200, 150, 180]])
+    groups = ["treatment", "control", "treatment"]
+
+    for method in differential_abundance.DIFFERENTIAL_METHODS.values():
+        with pytest.raises(TypeError):
+            method(counts, groups, None, None, None)
+
+
+def test_run_deseq2_third_positional_is_alpha(capsys):
+    counts = np.array([[100, 50, 75], [200, 150, 180]])
+    groups = ["treatment", "control", "treatment"]
+
+    differential_abundance.run_deseq2(counts, groups, 0.01)
+
+    assert "alpha=0.01" in capsys.readouterr().out
@@ -0,0 +1,173 @@
+"""Tests for scripts/diversity_analysis.py."""
+import numpy as np
+import pytest
+from scipy import sparse
+from scipy.spatial.distance import pdist, squareform
+
+import diversity_analysis
+
+
+def _sparse_table(seed=0, n_taxa=400, n_samples=30, density=0.05):
+    rng = np.random.default_rng(seed)
+    present = rng.random((n_taxa, n_samples)) < density
+    return present * rng.integers(1, 50, (n_taxa, n_samples))
+
+
+@pytest.mark.parametrize("scale", [1, 0.37])
+def test_sparse_bray_curtis_matches_pdist(scale):
+    table = _sparse_table() * scale
+    expected = squareform(pdist(table.T, "braycurtis"))
+
+    result = diversity_analysis._bray_curtis_from_sparse(sparse.csc_matrix(table))
+
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result, expected, atol=1e-6)
+
+
+def _permanova_reference(dist, groups):
+    """Pseudo-F and R2 from the textbook sums of squares, in float64."""
+    dist = np.asarray(dist, dtype=np.float64)
+    groups = np.asarray(groups)
+    n = len(groups)
+    labels = np.unique(groups)
+    total = sum(dist[i, j] ** 2 for i in range(n) for j in range(i + 1, n)) / n
+    within = 0.0
+    for label in labels:
+        members = np.flatnonzero(groups == label)
+        pairs = sum(dist[i, j] ** 2 for i in members for j in members if i < j)
+        within += pairs / len(members)
+    f_stat = ((total - within) / (len(labels) - 1)) / (within / (n - len(labels)))
+    return f_stat, 1 - within / total
+
+
+def test_permanova_matches_float64_reference():
+    rng = np.random.default_rng(1)
+    points = rng.random((24, 5))
+    points[:8] += 0.5
+    dist = squareform(pdist(points))
+    groups = ["a"] * 8 + ["b"] * 10 + ["c"] * 6
+
+    result = diversity_analysis.run_permanova(dist, groups, permutations=199, seed=0)
+
+    f_stat, r2 = _permanova_reference(dist, groups)
+    assert result["F_statistic"] == pytest.approx(f_stat, rel=1e-5)
+    assert result["R2"] == pytest.approx(r2, rel=1e-5)
+    assert 0 < result["p_value"] <= 1
+
+
+def test_permanova_p_value_independent_of_n_processes():
+    rng = np.random.default_rng(2)
+    dist = squareform(pdist(rng.random((30, 4))))
+    groups = np.arange(30) % 2
+
+    serial = diversity_analysis.run_permanova(dist, groups, permutations=999, seed=3)
+    parallel = diversity_analysis.run_permanova(dist, groups, permutations=999, seed=3, n_processes=4)
+
+    assert serial == parallel
+
+
+@pytest.mark.parametrize("groups", [["a"] * 4, ["a", "b", "c", "d"]])
+def test_permanova_rejects_untestable_groups(groups):
+    dist = squareform(pdist(np.arange(8.0).reshape(4, 2)))
+
+    with pytest.raises(ValueError):
+        diversity_analysis.run_permanova(dist, groups, permutations=9)
+
+
+def test_permanova_rejects_zero_distances():
+    with pytest.raises(ValueError):
+        diversity_analysis.run_permanova(np.zeros((4, 4)), ["a", "a", "b", "b"], permutations=99)
+
+
+def test_permanova_rejects_nan_distances():
+    table = np.array([[5, 0, 0, 3], [2, 0, 0, 4]])
+    dist = diversity_analysis.calculate_beta_diversity(table)
+    assert np.isnan(dist).any()
+
+    with pytest.raises(ValueError):
+        diversity_analysis.run_permanova(dist, ["a", "a", "b", "b"], permutations=9)
+
+
+def test_rarefy_samples_subsamples_to_depth():
+    table = _sparse_table(density=0.5) * 3
+    lib_size = table.sum(axis=0)
+    depth = int(np.median(lib_size))
+
+    rarefied = diversity_analysis.rarefy_samples(table, depth, seed=7).toarray()
+
+    above = lib_size > depth
+    assert above.any() and (~above).any()
+    assert (rarefied[:, above].sum(axis=0) == depth).all()
+    np.testing.assert_array_equal(rarefied[:, ~above], table[:, ~above])
+    assert (rarefied <= table).all()
+    np.testing.assert_array_equal(
+        rarefied, diversity_analysis.rarefy_samples(table, depth, seed=7).toarray()
+    )
+
+
+@pytest.mark.parametrize("dense", [False, True])
+def test_jaccard_matches_pdist(dense):
+    table = _sparse_table(density=0.2)
+    table[:, [3, 5]] = 0  # Two empty samples are identical
+    expected = squareform(pdist(table.T > 0, "jaccard"))
+
+    result = diversity_analysis._jaccard(sparse.csc_matrix(table), dense=dense)
+
+    assert result.dtype == np.float32
+    assert result[3, 5] == 0
+    np.testing.assert_allclose(result, expected, atol=1e-6)
+
+
+def test_permanova_deduplicated_labelings_match_full_evaluation(monkeypatch):
+    rng = np.random.default_rng(1)
+    dist = squareform(pdist(rng.random((4, 3))))
+    groups = ["a", "a", "b", "b"]
+
+    deduplicated = diversity_analysis.run_permanova(dist, groups, permutations=9999, seed=5)
+
+    full_within_ss = diversity_analysis._permuted_within_ss
+    monkeypatch.setattr(
+        diversity_analysis,
+        "_permuted_within_ss",
+        lambda d2, labels, sizes, deduplicate: full_within_ss(d2, labels, sizes, False),
+    )
+    full = diversity_analysis.run_permanova(dist, groups, permutations=9999, seed=5)
+
+    assert deduplicated == full
+
+    # Two groups of two have 6 equally likely labelings
+    labelings = [(0, 0, 1, 1), (0, 1, 0, 1), (0, 1, 1, 0), (1, 0, 0, 1), (1, 0, 1, 0), (1, 1, 0, 0)]
+    f_stats = np.array([_permanova_reference(dist, np.array(labeling))[0] for labeling in labelings])
+    # Relative tolerance so float32 ties with the observed labeling still count
+    exact = np.mean(f_stats >= deduplicated["F_statistic"] * (1 - 1e-5))
+    assert deduplicated["p_value"] == pytest.approx(exact, abs=0.02)
+
+
+@pytest.mark.parametrize(
+    "counts, uses_table",
+    [
+        (_sparse_table(seed=5), True),
+        (_sparse_table(seed=6) * 3000, False),
+        (_sparse_table(seed=7) * 0.37, False),
+    ],
+    ids=["int-lookup", "int-above-table", "float"],
+)
+def test_shannon_matches_scipy_entropy(counts, uses_table):
+    from scipy.stats import entropy
+
+    counts[:, -1] = 0  # Empty sample has zero diversity
+    metrics = ["shannon", "shannon_log2"]
+    lib_size = counts.sum(axis=0)
+    proportions = counts / np.where(lib_size > 0, lib_size, 1)
+
+    result = diversity_analysis.calculate_alpha_diversity(sparse.csc_matrix(counts), metrics)
+    # Same counts as floats always take the np.log path
+    fallback = diversity_analysis.calculate_alpha_diversity(
+        sparse.csc_matrix(counts.astype(np.float64)), metrics
+    )
+
+    assert (counts.dtype.kind in "iu" and counts.max() < 2 ** 16) == uses_table
+    for metric, base in [("shannon", None), ("shannon_log2", 2)]:
+        expected = np.nan_to_num(entropy(proportions, base=base, axis=0))
+        np.testing.assert_allclose(result[metric], expected, rtol=1e-10, atol=1e-12)
+        np.testing.assert_allclose(result[metric], fallback[metric], rtol=1e-12, atol=1e-12)
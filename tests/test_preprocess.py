@@ -0,0 +1,60 @@
+"""Tests for scripts/preprocess.py."""
+import gzip
+
+import numpy as np
+import pytest
+
+import preprocess
+
+# Passing, low quality, too short, passing with CRLF line endings
+FASTQ = (
+    "@r1\n" + "A" * 300 + "\n+\n" + "I" * 300 + "\n"
+    "@r2\n" + "C" * 300 + "\n+\n" + "+" * 300 + "\n"
+    "@r3\n" + "G" * 100 + "\n+\n" + "I" * 100 + "\n"
+    "@r4\r\n" + "T" * 260 + "\r\n+\r\n" + "?" * 260 + "\r\n"
+)
+EXPECTED = [True, False, False, True]
+
+
+@pytest.mark.parametrize("kernel", ["compiled", "py_func"])
+def test_filter_fastq_kernel(kernel):
+    func = preprocess._filter_fastq
+    if kernel == "py_func":
+        func = getattr(func, "py_func", func)
+    buf = np.frombuffer(FASTQ.encode(), dtype=np.uint8)
+
+    passed = func(buf, 30, 250, 500)
+
+    assert passed.tolist() == EXPECTED
+
+
+def test_quality_filter_reads_plain_and_gzipped_files(tmp_path):
+    plain = tmp_path / "reads.fastq"
+    plain.write_text(FASTQ, newline="")
+    gzipped = tmp_path / "reads.fastq.gz"
+    with gzip.open(gzipped, "wt", newline="") as f:
+        f.write(FASTQ)
+
+    assert preprocess.quality_filter(plain).tolist() == EXPECTED
+    assert preprocess.quality_filter(gzipped).tolist() == EXPECTED
+
+
+@pytest.mark.parametrize("reads", [["rec1", "rec2"], "no_such_file.fastq"])
+def test_quality_filter_returns_non_file_input_unchanged(reads):
+    assert preprocess.quality_filter(reads) is reads
+
+
+def test_assign_taxonomy_classifies_each_sequence_once():
+    preprocess._classify_one.cache_clear()
+    seq1 = preprocess._SIMULATED_SEQUENCES["ASV1"]
+    seq2 = preprocess._SIMULATED_SEQUENCES["ASV2"]
+
+    taxonomy = preprocess.assign_taxonomy({"ASV1": seq1, "ASV2": seq2, "ASV3": seq1})
+    preprocess.assign_taxonomy([seq1])
+
+    assert taxonomy == {"ASV1": "Bacteroides", "ASV2": "Prevotella", "ASV3": "Bacteroides"}
+    info = preprocess._classify_one.cache_info()
+    assert (info.misses, info.hits) == (2, 2)
+
+    preprocess.assign_taxonomy([seq1], database="greengenes_13_8")
+    assert preprocess._classify_one.cache_info().misses == 3